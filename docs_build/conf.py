@@ -19,11 +19,12 @@ release = f'v{__version__}'
 # -- General configuration ---------------------------------------------------
 # https://www.sphinx-doc.org/en/master/usage/configuration.html#general-configuration
 
-extensions = ['sphinx.ext.todo', 'sphinx.ext.viewcode', 'sphinx.ext.autodoc',
-              'sphinx.ext.autosummary']
+# autoapi parses the source statically, autodoc/autosummary (which import the package) are not needed
+extensions = ['sphinx.ext.todo', 'sphinx.ext.viewcode']
 extensions.append('autoapi.extension')
 
-# Auto API settings
+# Auto API settings (requires sphinx-autoapi>=3.0)
+autoapi_generate_api_docs = True
 autoapi_implicit_namespaces = True  # Allow for implicit namespaces
 autoapi_keep_files = True  # Keep the generated files (for debugging)
 autoapi_ignore = []  # Ignore these files
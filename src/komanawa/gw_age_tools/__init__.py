@@ -7,4 +7,4 @@ from komanawa.gw_age_tools.exponential_piston_flow import exponential_piston_flo
     binary_exp_piston_flow, exponential_piston_flow, make_age_dist, check_age_inputs
 from komanawa.gw_age_tools.source_predictions import predict_future_conc_bepm, \
     predict_source_future_past_conc_bepm, predict_historical_source_conc
-from komanawa.gw_age_tools.lightweight import lightweight_predict_future
+from komanawa.gw_age_tools.lightweight import lightweight_predict_future, predict_future_conc_bepm_batch
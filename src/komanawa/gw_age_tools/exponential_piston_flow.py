@@ -2,6 +2,7 @@
 created matt_dumont 
 on: 10/07/23
 """
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 
@@ -78,7 +79,8 @@ def binary_exp_piston_flow_cdf(t, mrt_p1, mrt_p2, frac_p1, f_p1, f_p2):
 
 def check_age_inputs(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2):
     """
-    convenience function to check BEPM age inputs
+    convenience function to check BEPM age inputs, results are cached so all inputs must be scalars (numbers or None,
+    0-d arrays are converted to numbers)
 
     :param mrt: mean residence time of the source (yrs) either mrt or mrt_p2 can be None
     :param mrt_p1: mean residence time of the first piston flow component (yrs)
@@ -89,6 +91,14 @@ def check_age_inputs(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2):
     :param f_p2: fraction of the second piston flow component that is in the fast flow component
     :return:
     """
+    return _check_age_inputs(*_scalar_args(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2))
+
+
+@lru_cache(maxsize=1024, typed=True)
+def _check_age_inputs(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2):
+    """
+    cached implementation of check_age_inputs
+    """
     if frac_p1 == 1:
         mrt_p2 = np.nan
         if mrt is None and mrt_p1 is not None:
@@ -125,7 +135,8 @@ def check_age_inputs(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2):
 
 def make_age_dist(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2, start=np.nan):
     """
-    make an age distribution for the binary exponential piston flow model
+    make an age distribution for the binary exponential piston flow model, results are cached so all inputs must be
+    scalars (numbers or None, 0-d arrays are converted to numbers)
 
     :param mrt: mean residence time of the source (yrs) either mrt or mrt_p2 can be None
     :param mrt_p1: mean residence time of the first piston flow component (yrs)
@@ -138,14 +149,65 @@ def make_age_dist(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2, start=np.
     :return: a tuple
 
              * age_step: the step size of the age distribution (yrs)
-             * ages: the ages of the age distribution (yrs)
-             * age_fractions: the fractions of the age distribution (decimal)
+             * ages: the ages of the age distribution (yrs), C-contiguous float64
+             * age_fractions: the fractions of the age distribution (decimal), C-contiguous float64
+
+    """
+    age_step, ages, age_fractions = _make_age_dist(*_scalar_args(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2,
+                                                                 start))
+    return age_step, ages.copy(), age_fractions.copy()
+
 
+@lru_cache(maxsize=32, typed=True)  # each entry holds two arrays of up to ~1e7 values at high precision
+def _make_age_dist(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2, start):
     """
-    check_age_inputs(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2)
+    cached implementation of make_age_dist, the returned arrays are shared between calls and are read only
+    """
+    _check_age_inputs(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2)
     age_step = round(10 ** -precision, precision)
-    ages = np.arange(0, np.nanmax([mrt_p1*5, mrt_p2*5, start]), age_step).round(precision)
+    ages = _lattice_arange(0, np.nanmax([mrt_p1 * 5, mrt_p2 * 5, start]), precision) / 10 ** precision
     age_cdf = binary_exp_piston_flow_cdf(ages, mrt_p1, mrt_p2, frac_p1, f_p1, f_p2)
     age_fractions = np.diff(age_cdf, prepend=0)
     age_fractions = age_fractions / age_fractions.sum()
+    ages = np.ascontiguousarray(ages, dtype=np.float64)
+    age_fractions = np.ascontiguousarray(age_fractions, dtype=np.float64)
+    ages.setflags(write=False)
+    age_fractions.setflags(write=False)
     return age_step, ages, age_fractions
+
+
+def _scalar_args(*args):
+    """
+    convert 0-d arrays (e.g. np.array(30.)) to numbers so they can be used as lru_cache keys
+
+    :param args: the inputs to the cached function
+    :return: tuple of the inputs
+    """
+    return tuple(arg.item() if isinstance(arg, np.ndarray) and arg.ndim == 0 else arg for arg in args)
+
+
+def _to_lattice(times, precision):
+    """
+    convert times (yrs) to integer lattice coordinates (time * 10**precision)
+
+    :param times: np.ndarray or scalar of times (yrs)
+    :param precision: precision of the age distribution (decimal places)
+    :return: np.ndarray (int64) of lattice coordinates
+    """
+    return np.rint(np.asarray(times, dtype=np.float64) * 10 ** precision).astype(np.int64)
+
+
+def _lattice_arange(start, stop, precision):
+    """
+    integer lattice version of np.arange(start, stop, 10**-precision).round(precision), exact and without the float
+    edge case where stop is (or is not) included due to accumulated error
+
+    :param start: start time (yrs), inclusive
+    :param stop: stop time (yrs), exclusive
+    :param precision: precision of the age distribution (decimal places)
+    :return: np.ndarray (int64) of lattice coordinates, divide by 10**precision for times
+    """
+    scale = 10 ** precision
+    # ceil for off lattice bounds, the rounding absorbs float noise on lattice bounds (e.g. (50 + 0.01) * 100)
+    start_i, stop_i = np.ceil(np.round(np.array([start, stop], dtype=np.float64) * scale, 6)).astype(np.int64)
+    return np.arange(start_i, stop_i, dtype=np.int64)
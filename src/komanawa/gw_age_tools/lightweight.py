@@ -2,8 +2,22 @@
 created matt_dumont 
 on: 16/05/24
 """
+from collections import namedtuple
 import numpy as np
 import pandas as pd
+from komanawa.gw_age_tools.exponential_piston_flow import _to_lattice
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is an optional dependency, fall back to the numpy/scipy convolution
+    njit = None
+
+fft_min_taps = 512  # minimum number of age fractions before the fft convolution is considered
+float32_max_precision = 4  # the jit receptor kernel is run in float32 when precision <= this (see _datapath_dtype)
+
+# a regular source concentration time series on the integer lattice (time * 10**precision):
+# values[i] is the concentration at lattice time t0_i + i
+_SourceGrid = namedtuple('_SourceGrid', 't0_i values')
 
 
 def lightweight_predict_future(source, out_years, ages, age_fractions, precision):
@@ -17,13 +31,230 @@ def lightweight_predict_future(source, out_years, ages, age_fractions, precision
     :param precision:
     :return:
     """
-    out_conc = np.full_like(out_years, np.nan)
-    for i, t in enumerate(out_years):
-        out_conc[i] = (source.loc[(t - ages).round(precision)] * age_fractions).sum()
+    source_grid = _source_grid(source, precision)
+    out_conc = _convolve_source_conc(source_grid, _to_lattice(out_years, precision), _to_lattice(ages, precision),
+                                     age_fractions, dtype=_datapath_dtype(precision, source_grid.values))
     receptor_conc = pd.Series(index=out_years, data=out_conc)
     return receptor_conc
 
 
+def predict_future_conc_bepm_batch(sources, out_years, ages, age_fractions, precision):
+    """
+    a lightweight batch version of lightweight_predict_future for many sites that share the same age distribution
+    (e.g. many wells with the same BEPM parameters). If numba is installed the sites are run in parallel. Like
+    lightweight_predict_future this does not check inputs... use at your own warning.  For a single site keep using
+    lightweight_predict_future (or predict_future_conc_bepm)
+
+    :param sources: pd.DataFrame of the source concentrations indexed by time (yrs) with one column per site, must include every 10**-precision step and must not contain missing values
+    :param out_years: np.ndarray of years to predict
+    :param ages: np.ndarray of ages from make_age_dist
+    :param age_fractions: np.ndarray of age fractions from make_age_dist
+    :param precision: precision of the age distribution (decimal places)
+    :return: pd.DataFrame of the receptor concentrations indexed by out_years with the same columns as sources
+    """
+    t0_i, source_values = _source_grid(sources, precision)
+    ages_i = _to_lattice(ages, precision)
+    out_years_i = _to_lattice(out_years, precision)
+    dtype = _datapath_dtype(precision, source_values)
+    source_values = np.ascontiguousarray(source_values.T)  # one row per site
+    out_conc = np.empty((source_values.shape[0], out_years_i.size), dtype=np.float64)
+    _check_source_coverage(out_years_i - ages_i[0] - t0_i, ages_i, source_values.shape[1])
+    if _use_jit_kernel(source_values.shape[1], len(age_fractions), out_years_i.size):
+        _batch_conv_kernel(source_values.astype(dtype, copy=False), ages_i - ages_i[0],
+                           np.ascontiguousarray(age_fractions, dtype=dtype), out_years_i - ages_i[0] - t0_i, out_conc)
+    else:
+        for i, values in enumerate(source_values):
+            _convolve_source_conc(_SourceGrid(t0_i, values), out_years_i, ages_i, age_fractions, out=out_conc[i],
+                                  dtype=dtype)
+    receptor_conc = pd.DataFrame(index=out_years, data=out_conc.T, columns=sources.columns)
+    return receptor_conc
+
+
+def _datapath_dtype(precision, values):
+    """
+    the dtype of the jit receptor kernel datapath, float32 when precision <= float32_max_precision and the float32
+    rounding of the source (relative error <= eps) cannot move the receptor concentration by more than 10**-precision,
+    otherwise float64. The kernel accumulates in float64 and the np.convolve/fftconvolve paths always run in float64.
+
+    :param precision: precision of the age distribution (decimal places)
+    :param values: np.ndarray of the source concentrations
+    :return: np.float32 or np.float64
+    """
+    if precision > float32_max_precision:
+        return np.float64
+    # nan concentrations fail the comparison and stay in float64
+    max_conc = np.abs(values).max() if np.size(values) else 0.
+    return np.float32 if max_conc * np.finfo(np.float32).eps <= 10 ** -precision else np.float64
+
+
+def _source_grid(source, precision):
+    """
+    convert a source concentration series (or frame) to a _SourceGrid, times between the 10**-precision steps are
+    dropped (as the label lookup of the original implementation)
+
+    :param source: pd.Series (or pd.DataFrame) of source concentrations indexed by time, must include every
+                   10**-precision step from the first to the last time
+    :param precision: precision of the age distribution (decimal places)
+    :return: _SourceGrid (values is 2d for a pd.DataFrame)
+    """
+    source = source.sort_index()
+    times = source.index.to_numpy(np.float64)
+    values = source.to_numpy(np.float64, copy=False)
+    times_i = _to_lattice(times, precision)
+    on_lattice = np.abs(times * 10 ** precision - times_i) < 1e-6
+    if not on_lattice.all():
+        times_i, values = times_i[on_lattice], values[on_lattice]
+    if times_i.size == 0 or not np.array_equal(times_i, times_i[0] + np.arange(times_i.size)):
+        raise KeyError(f'source must include every {10 ** -precision} step from the first to the last time')
+    return _SourceGrid(t0_i=int(times_i[0]), values=values)
+
+
+def _convolve_source_conc(source, out_times_i, ages_i, age_fractions, out=None, dtype=np.float64):
+    """
+    convolve a regular source concentration time series with an age distribution to get the receptor concentration
+
+    the receptor concentration at time t is sum(source(t - ages) * age_fractions), which is a discrete convolution of
+    the source with the age fractions, so this is computed once over the full source and then sampled at out_times.
+    Long age distributions (> fft_min_taps) are convolved via fft when it is cheaper than the direct convolution.
+    If numba is installed the receptor concentration is calculated only at out_times with a jit kernel
+    (_conv_kernel) unless the fft is cheaper
+
+    all times are integer lattice coordinates (see _to_lattice) so the source lookup is values[t_i - ages_i - t0_i]
+
+    :param source: _SourceGrid of the source concentration, on the same lattice as the age distribution
+    :param out_times_i: np.ndarray (int) of lattice times to calculate the receptor concentration for
+    :param ages_i: np.ndarray (int) of lattice ages (regular step) from make_age_dist
+    :param age_fractions: np.ndarray of age fractions from make_age_dist
+    :param out: None or np.ndarray (float64, same shape as out_times_i) to write the receptor concentrations to
+    :param dtype: dtype of the jit kernel datapath (see _datapath_dtype), the convolutions always run in float64
+    :return: np.ndarray (float64) of receptor concentrations at out_times_i (out if passed)
+    """
+    n, m = len(source.values), len(age_fractions)
+    idx = np.asarray(out_times_i, dtype=np.int64) - ages_i[0] - source.t0_i
+    _check_source_coverage(idx, ages_i, n)
+    if _use_jit_kernel(n, m, idx.size):
+        if out is None:
+            out = np.empty(idx.shape, dtype=np.float64)
+        # the kernel assumes C-contiguous arrays of the datapath dtype (a no-op for make_age_dist outputs in float64)
+        _conv_kernel(np.ascontiguousarray(source.values, dtype=dtype), np.asarray(ages_i - ages_i[0], dtype=np.int64),
+                     np.ascontiguousarray(age_fractions, dtype=dtype), idx, out)
+        return out
+    source_values = np.asarray(source.values, dtype=np.float64)
+    age_fractions = np.asarray(age_fractions, dtype=np.float64)
+    if _use_fft(n, m):
+        from scipy.signal import fftconvolve  # scipy.signal is slow to import and only needed for long ages
+        conv = fftconvolve(source_values, age_fractions, mode='full')
+    else:
+        conv = np.convolve(source_values, age_fractions, mode='full')
+    if out is None:
+        out = np.empty(idx.shape, dtype=np.float64)
+    out[:] = conv[idx]
+    return out
+
+
+def _check_source_coverage(idx, ages_i, source_size):
+    """
+    check that the source covers out_times - ages for every output time, otherwise the jit kernel would index out of
+    bounds and the convolution would silently zero pad
+
+    :param idx: np.ndarray (int) of output times as source indices relative to the first age
+    :param ages_i: np.ndarray (int) of lattice ages (regular step, sorted) from make_age_dist
+    :param source_size: number of source values
+    :return:
+    """
+    if idx.size == 0:
+        return
+    assert (idx.min() - (ages_i[-1] - ages_i[0]) >= 0
+            and idx.max() < source_size), 'source does not cover all out_times - ages'
+
+
+def _use_fft(n, m):
+    """
+    cost model for the full convolution, True if the fft convolution is cheaper than the direct convolution
+
+    :param n: number of source values
+    :param m: number of age fractions
+    :return: bool
+    """
+    return m > fft_min_taps and n * m > 3 * (n + m) * np.log2(n + m)
+
+
+def _use_jit_kernel(n, m, n_out):
+    """
+    True if numba is available and the jit kernel (only evaluated at the n_out output times) is cheaper than the fft
+
+    :param n: number of source values
+    :param m: number of age fractions
+    :param n_out: number of output times
+    :return: bool
+    """
+    return njit is not None and not (_use_fft(n, m) and n_out * m > 3 * (n + m) * np.log2(n + m))
+
+
+def _receptor_matrix(source_t0_i, source_size, out_times_i, ages_i, age_fractions):
+    """
+    build the (toeplitz) receptor operator T so that receptor_conc = T @ source.values for any source on the same
+    grid, useful when the same output times and age distribution are evaluated many times (e.g. curve_fit)
+
+    :param source_t0_i: lattice time of the first source value (_SourceGrid.t0_i)
+    :param source_size: number of source values
+    :param out_times_i: np.ndarray (int) of lattice times to calculate the receptor concentration for
+    :param ages_i: np.ndarray (int) of lattice ages (regular step) from make_age_dist
+    :param age_fractions: np.ndarray of age fractions from make_age_dist
+    :return: np.ndarray (float64) of shape (len(out_times_i), source_size)
+    """
+    idx = np.asarray(out_times_i, dtype=np.int64) - ages_i[0] - source_t0_i
+    _check_source_coverage(idx, ages_i, source_size)
+    # row i holds the age fractions reversed, ending at the source index of out_times_i[i] - ages_i[0]
+    rev_fractions = np.ascontiguousarray(age_fractions, dtype=np.float64)[::-1]
+    m = rev_fractions.size
+    out = np.zeros((idx.size, source_size), dtype=np.float64)
+    for i, j in enumerate(idx):
+        out[i, j - m + 1:j + 1] = rev_fractions
+    return out
+
+
+if njit is not None:
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _conv_kernel(src, ages_int, age_fractions, out_times_int, out):
+        """
+        jit receptor concentration kernel, out[i] = sum(src[out_times_int[i] - ages_int] * age_fractions)
+
+        :param src: np.ndarray (float32/float64) of source concentrations on a regular grid
+        :param ages_int: np.ndarray (int64) of ages as grid steps relative to the first age
+        :param age_fractions: np.ndarray (same dtype as src) of age fractions
+        :param out_times_int: np.ndarray (int64) of output times as grid indices (relative to the first age)
+        :param out: np.ndarray (float64) to write the receptor concentrations to
+        :return:
+        """
+        for i in prange(out.size):
+            acc = 0.0
+            base = out_times_int[i]
+            for k in range(ages_int.size):
+                acc += src[base - ages_int[k]] * age_fractions[k]
+            out[i] = acc
+
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _batch_conv_kernel(src, ages_int, age_fractions, out_times_int, out):
+        """
+        jit batch receptor concentration kernel, _conv_kernel for each site (row of src) in parallel
+
+        :param src: np.ndarray (float32/float64) of shape (n_sites, n_times) source concentrations on a regular grid
+        :param ages_int: np.ndarray (int64) of ages as grid steps relative to the first age
+        :param age_fractions: np.ndarray (same dtype as src) of age fractions
+        :param out_times_int: np.ndarray (int64) of output times as grid indices (relative to the first age)
+        :param out: np.ndarray (float64) of shape (n_sites, n_out) to write the receptor concentrations to
+        :return:
+        """
+        for s in prange(src.shape[0]):
+            for i in range(out_times_int.size):
+                acc = 0.0
+                base = out_times_int[i]
+                for k in range(ages_int.size):
+                    acc += src[s, base - ages_int[k]] * age_fractions[k]
+                out[s, i] = acc
+
+
 def _lightweight_predict_future_int(source, out_years, ages, age_fractions):
     """
     a lightweight version of predict_future_conc_bepm that does not check inputs and does not interpolate the source concentration and does not check the parmeters... use at your own warning
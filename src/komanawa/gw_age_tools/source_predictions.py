@@ -6,7 +6,9 @@ import warnings
 import numpy as np
 import pandas as pd
 from scipy.optimize import curve_fit
-from komanawa.gw_age_tools.exponential_piston_flow import make_age_dist, check_age_inputs
+from komanawa.gw_age_tools.exponential_piston_flow import make_age_dist, check_age_inputs, _to_lattice, \
+    _lattice_arange
+from komanawa.gw_age_tools.lightweight import _convolve_source_conc, _SourceGrid, _receptor_matrix, _datapath_dtype
 
 
 def predict_source_future_past_conc_bepm(initial_conc, mrt, mrt_p1, frac_p1, f_p1, f_p2,
@@ -46,19 +48,26 @@ def predict_source_future_past_conc_bepm(initial_conc, mrt, mrt_p1, frac_p1, f_p
                                                       prev_slope=prev_slope, max_conc=max_conc, min_conc=min_conc,
                                                       start_age=start, precision=precision)
 
-    fut_idx = np.arange(0, stop + age_step, age_step).round(precision)
-
-    source_future_conc = pd.Series(
-        index=fut_idx,
-        data=source_conc_past.loc[0] + fut_slope * fut_idx
-    )
-    source_future_conc = source_future_conc.clip(lower=min_fut_conc, upper=max_fut_conc)
-
-    total_source_conc = pd.concat([source_conc_past.drop(index=0), source_future_conc]).sort_index()
-    out_years = np.arange(start, stop, age_step).round(precision)
-    out_conc = np.full_like(out_years, np.nan)
-    for i, t in enumerate(out_years):
-        out_conc[i] = (total_source_conc.loc[(t - ages).round(precision)] * age_fractions).sum()
+    # source_conc_past is indexed from 0 into the past, so reversed it is in time order on the lattice and time 0 is
+    # at zero_idx (dropped as it is the first value of the future source)
+    past_index = source_conc_past.index.values[::-1]
+    past_values = source_conc_past.values[::-1]
+    past_t0_i = int(_to_lattice(past_index[0], precision))
+    zero_idx = -past_t0_i
+
+    fut_idx = _lattice_arange(0, stop + age_step, precision) / 10 ** precision
+    fut_values = past_values[zero_idx] + fut_slope * fut_idx
+    np.clip(fut_values, min_fut_conc, max_fut_conc, out=fut_values)
+
+    total_index = np.concatenate([past_index[:zero_idx], fut_idx])
+    total_values = np.concatenate([past_values[:zero_idx], fut_values])
+    source_grid = _SourceGrid(past_t0_i, total_values)
+    total_source_conc = pd.Series(total_values, index=total_index, copy=False)
+
+    out_years_i = _lattice_arange(start, stop, precision)
+    out_years = out_years_i / 10 ** precision
+    out_conc = _convolve_source_conc(source_grid, out_years_i, _to_lattice(ages, precision),
+                                     age_fractions, dtype=_datapath_dtype(precision, total_values))
     receptor_conc = pd.Series(index=out_years, data=out_conc)
 
     return total_source_conc, receptor_conc
@@ -100,29 +109,30 @@ def predict_future_conc_bepm(once_and_future_source_conc: pd.Series, predict_sta
     assert pd.api.types.is_number(fill_threshold), 'fill_threshold must be a number'
 
     # make the source concentration a regular series
-    once_and_future_source_conc = once_and_future_source_conc.copy(True)
-    once_and_future_source_conc.index = once_and_future_source_conc.index.values.round(precision)
-    expect_idx_vals = np.arange(once_and_future_source_conc.index.min(),
-                                once_and_future_source_conc.index.max() + age_step,
-                                age_step).round(precision)
-    temp = pd.Series(index=expect_idx_vals, data=np.nan)
-    temp.loc[once_and_future_source_conc.index] = once_and_future_source_conc.values
-    once_and_future_source_conc = temp
-    once_and_future_source_conc = once_and_future_source_conc.sort_index()
-    once_and_future_source_conc = once_and_future_source_conc.interpolate(method='linear', limit_direction='both')
+    # the grid spans the full index, missing values (including at the ends) are interpolated from the passed values,
+    # np.interp holds the end values constant (as interpolate(limit_direction='both'))
+    input_index = once_and_future_source_conc.index.values.round(precision)
+    expect_idx_i = _lattice_arange(input_index.min(), input_index.max() + age_step, precision)
+    expect_idx_vals = expect_idx_i / 10 ** precision
+    input_source_conc = pd.Series(index=input_index, data=once_and_future_source_conc.values).dropna().sort_index()
+    source_grid = _SourceGrid(int(expect_idx_i[0]),
+                              np.interp(expect_idx_vals, input_source_conc.index.values, input_source_conc.values))
 
     # check that enough concentration data has been passed for the stop,
-    if predict_stop > once_and_future_source_conc.index.max():
+    if predict_stop > expect_idx_vals.max():
         raise ValueError(f'predict_stop ({predict_stop}) must be less than or equal to the max age of the source '
-                         f'({once_and_future_source_conc.index.max()})')
+                         f'({expect_idx_vals.max()})')
 
     # check the start
-    pred_ages = (predict_start - ages).round(precision)
-    idx = np.in1d(pred_ages, once_and_future_source_conc.index)
+    ages_i = _to_lattice(ages, precision)
+    pred_ages_i = _to_lattice(predict_start, precision) - ages_i
+    offsets = pred_ages_i - source_grid.t0_i
+    idx = (offsets >= 0) & (offsets < source_grid.values.size)
     if not idx.all():
+        pred_ages = pred_ages_i / 10 ** precision
         missing_age_frac = age_fractions[~idx].sum()
-        minium_pass_age = np.flip(pred_ages)[(np.flip(age_fractions).cumsum() >= fill_threshold).argmax()]
         if missing_age_frac > fill_threshold:
+            minium_pass_age = pred_ages[::-1][np.searchsorted(age_fractions[::-1].cumsum(), fill_threshold)]
             raise ValueError(
                 f'the source concentration is missing {missing_age_frac * 100:0.2f}% of the concentration on'
                 f' the old end of the source.  This is greater than the fill_threshold of '
@@ -135,13 +145,15 @@ def predict_future_conc_bepm(once_and_future_source_conc: pd.Series, predict_sta
                           f'{fill_value} and the prediction will be made. To avoid this warning pass concentration '
                           f'data from at least {pred_ages.min()} years')
 
-            once_and_future_source_conc = pd.concat((once_and_future_source_conc,
-                                                     pd.Series(index=pred_ages[~idx], data=fill_value)))
+            # the missing ages are all older than the source start, so prepend the fill values
+            n_fill = -offsets.min()
+            source_grid = _SourceGrid(source_grid.t0_i - n_fill,
+                                      np.concatenate([np.full(n_fill, fill_value, dtype=np.float64),
+                                                      source_grid.values]))
 
     out_times = np.arange(predict_start, predict_stop, pred_step).round(precision)
-    out_conc = np.full_like(out_times, np.nan)
-    for i, t in enumerate(out_times):
-        out_conc[i] = (once_and_future_source_conc.loc[(t - ages).round(precision)] * age_fractions).sum()
+    out_conc = _convolve_source_conc(source_grid, _to_lattice(out_times, precision), ages_i, age_fractions,
+                                     dtype=_datapath_dtype(precision, source_grid.values))
     receptor_conc = pd.Series(index=out_times, data=out_conc)
     return receptor_conc
 
@@ -172,25 +184,39 @@ def predict_historical_source_conc(init_conc, mrt, mrt_p1, mrt_p2, frac_p1, f_p1
     mrt, mrt_p2 = check_age_inputs(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2)
     age_step, ages, age_fractions = make_age_dist(mrt, mrt_p1, mrt_p2, frac_p1, precision, f_p1, f_p2)
     t = np.arange(-5, 1, 1).astype(float)
-    ydata = pd.Series(index=t, data=init_conc + prev_slope * t)
+    ydata = init_conc + prev_slope * t
+    ages_i = _to_lattice(ages, precision)
+    ages_source_i = _lattice_arange(0, np.nanmax([mrt_p1, mrt_p2]) * 5 + 5 + age_step, precision)
+    ages_source = ages_source_i / 10 ** precision
+    source_t0_i = int(-ages_source_i[-1])
+    ages_source_rev = ages_source[::-1].copy()  # time order
+
+    # curve_fit always evaluates the same times with the same age distribution, so the receptor operator is built
+    # once and each evaluation is a single matmul
+    receptor_matrix = _receptor_matrix(source_t0_i, ages_source.size, _to_lattice(t, precision), ages_i,
+                                       age_fractions)
+
+    # workspace shared by all opt_func calls, returning work_out is safe as curve_fit subtracts ydata (a new array)
+    work_source = np.empty(ages_source.size, dtype=np.float64)
+    work_out = np.empty(t.size, dtype=np.float64)
 
     def opt_func(t_vals, source_slope, source_init_conc):
-        ages_source = np.arange(0, np.nanmax([mrt_p1, mrt_p2]) * 5 + 5 + age_step, age_step).round(precision)
-        total_source_conc = pd.Series(index=-ages_source, data=source_init_conc - source_slope * ages_source)
-        total_source_conc.loc[total_source_conc < min_conc] = min_conc
-
-        t_vals.round(precision)
-        out_conc = np.full_like(t_vals, np.nan)
-        for i, t in enumerate(t_vals):
-            out_conc[i] = (total_source_conc.loc[(t - ages).round(precision)] * age_fractions).sum()
-        return out_conc
-
-    (s_slope, s_init), pcov = curve_fit(opt_func, t, ydata, p0=p0,
+        np.multiply(ages_source_rev, -source_slope, out=work_source)
+        np.add(work_source, source_init_conc, out=work_source)
+        np.maximum(work_source, min_conc, out=work_source)
+        return np.dot(receptor_matrix, work_source, out=work_out)
+
+    def jac_func(t_vals, source_slope, source_init_conc):
+        # the source is linear in (slope, init) where it is not clipped to min_conc, so the receptor derivatives
+        # are the convolutions of the source derivatives (-ages, 1) masked to the unclipped ages
+        unclipped = (source_init_conc - source_slope * ages_source_rev >= min_conc).astype(np.float64)
+        return receptor_matrix @ np.column_stack([-ages_source_rev * unclipped, unclipped])
+
+    (s_slope, s_init), pcov = curve_fit(opt_func, t, ydata, p0=p0, jac=jac_func,
                                         bounds=([0, 0], [np.inf, max_conc]))
-    ages = np.arange(0., np.nanmax([mrt_p1, mrt_p2, np.abs(start_age)]) * 5 * 2 + age_step, age_step).round(
-        precision)
-    source_conc_past = pd.Series(index=ages * -1, data=s_init - s_slope * ages)
-    source_conc_past.loc[source_conc_past < min_conc] = min_conc
+    ages = _lattice_arange(0., np.nanmax([mrt_p1, mrt_p2, np.abs(start_age)]) * 5 * 2 + age_step,
+                           precision) / 10 ** precision
+    source_conc_past = pd.Series(index=ages * -1, data=np.maximum(s_init - s_slope * ages, min_conc))
     return source_conc_past
 
 
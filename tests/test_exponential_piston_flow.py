@@ -7,7 +7,9 @@ import numpy as np
 import pandas as pd
 from komanawa.gw_age_tools import binary_exp_piston_flow, binary_exp_piston_flow_cdf, predict_historical_source_conc, \
     predict_source_future_past_conc_bepm, predict_future_conc_bepm, check_age_inputs, make_age_dist
-from komanawa.gw_age_tools.lightweight import lightweight_predict_future_int_np, lightweight_predict_future
+from komanawa.gw_age_tools.exponential_piston_flow import _to_lattice
+from komanawa.gw_age_tools.lightweight import lightweight_predict_future_int_np, lightweight_predict_future, \
+    predict_future_conc_bepm_batch, _convolve_source_conc, _source_grid, _datapath_dtype, _use_jit_kernel, njit
 from copy import deepcopy
 from pathlib import Path
 
@@ -47,6 +49,28 @@ class TestExponentialPistonFlow(unittest.TestCase):
         # test approximate integration of pdf vs cdf
         self.assertTrue(np.allclose((out * step).cumsum(), out2))
 
+    def test_make_age_dist_cache(self):
+        inputs = (20, 10, None, 0.7, 2, 0.8, 0.75)
+        mrt, mrt_p2 = check_age_inputs(*inputs)
+        age_step, ages, age_fractions = make_age_dist(mrt, 10, mrt_p2, 0.7, 2, 0.8, 0.75)
+        expect_ages, expect_fractions = ages.copy(), age_fractions.copy()
+        ages[:] = -1
+        age_fractions[:] = -1
+        age_step2, ages2, age_fractions2 = make_age_dist(mrt, 10, mrt_p2, 0.7, 2, 0.8, 0.75)
+        self.assertEqual(age_step, age_step2)
+        self.assertTrue(np.array_equal(ages2, expect_ages))
+        self.assertTrue(np.array_equal(age_fractions2, expect_fractions))
+
+        # 0-d arrays are converted so they can be cache keys
+        age_step3, ages3, age_fractions3 = make_age_dist(mrt, 10, mrt_p2, 0.7, 2, 0.8, 0.75, start=np.array(30.))
+        _, expect_ages3, expect_fractions3 = make_age_dist(mrt, 10, mrt_p2, 0.7, 2, 0.8, 0.75, start=30.)
+        self.assertTrue(np.array_equal(ages3, expect_ages3))
+        self.assertTrue(np.array_equal(age_fractions3, expect_fractions3))
+
+        # cached results must not bypass the input checks
+        with self.assertRaises(AssertionError):
+            check_age_inputs(20, 10, None, 0.7, 2.0, 0.8, 0.75)
+
     def test_get_source_initial_conc_bepm(self, plot=plot_tests):
         mrt = 20
         mrt_p1 = 10
@@ -216,6 +240,88 @@ class TestExponentialPistonFlow(unittest.TestCase):
         v5 = lightweight_predict_future_int_np(source5, outages4, ages4, age_fractions, adder)
         self.assertTrue(np.allclose(v1.values, v5))
 
+    def test_lightweight_source_grid(self):
+        precision = 2
+        age_step, ages, age_fractions = make_age_dist(20, 20, np.nan, 1, precision, 0.8, 0.75)
+        index = np.arange(-ages.max(), 200, age_step).round(precision)
+        source = pd.Series(index=index, data=np.interp(index, [-ages.max(), 0, 50, 200], [1, 1, 18, 2.4]))
+        outages = np.linspace(1, 190, 10)
+        expect = lightweight_predict_future(source, outages, ages, age_fractions, precision)
+
+        # times between the precision steps are dropped
+        fine_index = np.arange(-ages.max(), 200, age_step / 2).round(precision + 1)
+        fine_source = pd.Series(index=fine_index,
+                                data=np.interp(fine_index, [-ages.max(), 0, 50, 200], [1, 1, 18, 2.4]))
+        data = lightweight_predict_future(fine_source, outages, ages, age_fractions, precision)
+        self.assertTrue(np.allclose(data.values, expect.values))
+
+        # a missing step raises, as the label lookup of the original implementation
+        with self.assertRaises(KeyError):
+            lightweight_predict_future(source.drop(index=source.index[5000]), outages, ages, age_fractions,
+                                       precision)
+
+    def test_predict_future_conc_bepm_batch(self):
+        precision = 2
+        mrt, mrt_p2 = check_age_inputs(20, 5, None, 0.2, precision, 0.8, 0.75)
+        age_step, ages, age_fractions = make_age_dist(mrt, 5, mrt_p2, 0.2, precision, 0.8, 0.75)
+        index = np.arange(-ages.max(), 200, age_step).round(precision)
+        sources = pd.DataFrame(index=index, data={
+            'site_a': np.interp(index, [-ages.max(), 0, 50, 200], [1, 1, 18, 2.4]),
+            'site_b': np.interp(index, [-ages.max(), 20, 100, 200], [2, 5, 3, 3]),
+        })
+        outages = np.linspace(1, 190, 500)
+        data = predict_future_conc_bepm_batch(sources, outages, ages, age_fractions, precision)
+        self.assertIsInstance(data, pd.DataFrame)
+        self.assertEqual(list(data.columns), ['site_a', 'site_b'])
+        for site in sources.columns:
+            expect = lightweight_predict_future(sources[site], outages, ages, age_fractions, precision)
+            self.assertTrue(np.allclose(data[site].values, expect.values))
+
+    @unittest.skipIf(njit is None, 'numba is not installed')
+    def test_predict_future_conc_bepm_batch_jit(self):
+        precision = 2
+        mrt, mrt_p2 = check_age_inputs(20, 5, None, 0.2, precision, 0.8, 0.75)
+        age_step, ages, age_fractions = make_age_dist(mrt, 5, mrt_p2, 0.2, precision, 0.8, 0.75)
+        index = np.arange(-ages.max(), 200, age_step).round(precision)
+        sources = pd.DataFrame(index=index, data={
+            'site_a': np.interp(index, [-ages.max(), 0, 50, 200], [1, 1, 18, 2.4]),
+        })
+        outages = np.linspace(1, 190, 5)  # sparse output times so the jit kernel is used
+        self.assertTrue(_use_jit_kernel(len(index), len(age_fractions), len(outages)))
+        data = predict_future_conc_bepm_batch(sources, outages, ages, age_fractions, precision)
+        expect = lightweight_predict_future(sources['site_a'], outages, ages, age_fractions, precision)
+        self.assertTrue(np.allclose(data['site_a'].values, expect.values))
+
+    def test_source_coverage(self):
+        precision = 2
+        age_step, ages, age_fractions = make_age_dist(20, 20, np.nan, 1, precision, 0.8, 0.75)
+        index = np.arange(0, 200, age_step).round(precision)
+        source = pd.Series(index=index, data=1.0)
+        # dense (convolution) and sparse (jit kernel when numba is installed) output times must both raise
+        for outages in (np.linspace(10, 190, 3000), np.array([10., 150.])):
+            with self.assertRaises(AssertionError):
+                lightweight_predict_future(source, outages, ages, age_fractions, precision)
+            with self.assertRaises(AssertionError):
+                predict_future_conc_bepm_batch(source.to_frame('site_a'), outages, ages, age_fractions, precision)
+
+    def test_float32_datapath(self):
+        for precision, max_conc in [(2, 18), (3, 18000), (4, 18000)]:
+            mrt, mrt_p2 = check_age_inputs(20, 10, None, 0.7, precision, 0.8, 0.75)
+            age_step, ages, age_fractions = make_age_dist(mrt, 10, mrt_p2, 0.7, precision, 0.8, 0.75)
+            index = _to_lattice(np.arange(-ages.max(), 200, age_step), precision) / 10 ** precision
+            source = pd.Series(index=index, data=np.interp(index, [-ages.max(), 0, 50, 200], [1, 1, max_conc, 2.4]))
+            source_grid = _source_grid(source, precision)
+            dtype = _datapath_dtype(precision, source_grid.values)
+            self.assertEqual(dtype, np.float32 if max_conc == 18 else np.float64)
+            ages_i = _to_lattice(ages, precision)
+            # sparse (jit kernel when numba is installed) and dense (fft, always float64) output times
+            for out_times, dt in [(np.linspace(1, 190, 50), dtype), (index[index > 1], np.float32)]:
+                out_times_i = _to_lattice(out_times, precision)
+                v64 = _convolve_source_conc(source_grid, out_times_i, ages_i, age_fractions, dtype=np.float64)
+                v32 = _convolve_source_conc(source_grid, out_times_i, ages_i, age_fractions, dtype=dt)
+                self.assertEqual(v32.dtype, np.float64)
+                self.assertTrue(np.allclose(v32, v64, rtol=0, atol=10 ** -precision))
+
 
 if __name__ == '__main__':
     unittest.main()